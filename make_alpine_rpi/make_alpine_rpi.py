@@ -5,6 +5,12 @@ Downloads Alpine latest iso for ARM, and builds a working headless filesystem
     for a Raspberry PI, with Ansible.
 """
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import email.utils
+import hashlib
+import hmac
+import json
 import sys
 
 from elevate import elevate
@@ -14,138 +20,289 @@ import os.path
 import re
 from urllib.parse import urlparse
 import shutil
+import tarfile
 import tempfile
 import urllib
 import subprocess
+import requests
 from util import *
 
-# Set up logging
+# Handlers are configured in main(), not at import
 logger = logging.getLogger('make_alpine_rpi')
-logger.setLevel(logging.DEBUG)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
 
 
 # For now use static URL
 alpine_url = 'http://dl-cdn.alpinelinux.org/alpine/v3.12/releases/armhf/alpine-rpi-3.12.0-armhf.tar.gz'
 alpine_sha256_url = 'http://dl-cdn.alpinelinux.org/alpine/v3.12/releases/armhf/alpine-rpi-3.12.0-armhf.tar.gz.sha256'
+# Cached file names for the above, parsed once
+alpine_basename = os.path.basename(urlparse(alpine_url).path)
+alpine_sha256_basename = os.path.basename(urlparse(alpine_sha256_url).path)
 # in the future, maybe can scrape "latest" from here?
 alpine_downloads_page_url = 'https://alpinelinux.org/downloads/'
 
-sd_target_image_size = 4 * 1024 * 1024 * 1024 #  4 Gig, bytes
-sd_part0_size = 32 * 1024 * 1024 # 32 MB, bytes
-sd_part1_size = 32 * 1024 * 1024 # 32 MB, bytes
-sd_part2_size = 4 * 1024 * 1024 * 1024 #  4 Gig, bytes
 
+@dataclass(frozen=True)
+class ImageLayout:
+    """SD card / image layout, in bytes."""
+    target: int = 4 << 30 # 4 GiB whole image
+    part0: int = 1 << 20 # 1 MiB, aligned for disk label
+    part1: int = 256 << 20 # 256 MiB FAT32 boot/installer partition
+    part2: int = 1 << 30 # 1 GiB ext4 root partition, for loopback images (devices use the remainder)
 
-def curl_retrieve_if_newer(url: str, targetdir: str, check_newer: bool = True):
+
+image_layout = ImageLayout()
+
+# One HTTP session for the whole run, so the tarball and sha256 fetches share DNS + TCP/TLS.
+# Retry connection failures on the pooled connection rather than surfacing the first reset.
+session = requests.Session()
+for scheme in ('http://', 'https://'):
+    session.mount(scheme, requests.adapters.HTTPAdapter(pool_maxsize=4, max_retries=3))
+download_chunk_size = 1 << 20 # 1 MiB
+download_timeout = (10, 60) # seconds: (connect, read between bytes), so a stalled CDN fails instead of hanging
+
+# External tools each command needs, checked up front for a clean error instead of a failure mid-build
+required_tools = {
+    'init': (),
+    'file': ('mkfs.fat', 'mkfs.ext4', 'mmd', 'mcopy'),
+    'liveimage': ('parted', 'partprobe', 'mkfs.fat', 'mkfs.ext4', 'mount', 'umount', 'sync'),
+}
+
+# Fixed argv prefixes for the formatters, built once
+mkfs_fat_argv = ('mkfs.fat', '-F32', '-n', 'BOOT')
+mkfs_ext4_argv = ('mkfs.ext4', '-t', 'ext4', '-L', 'root')
+
+
+def curl_retrieve_if_newer(url: str, targetdir: str, check_newer: bool = True, expected_sha256: str = None,
+                           targetfile_name: str = None):
     """ Retrieve the specified URL and store to the specified target directory.  Uses the source file name.
-        Wraps curl.
+        Fetches in-process over the shared requests session; writes to a .part file and renames on success,
+        so a failed transfer never truncates a good cached file.
+        If expected_sha256 is given, the body is hashed as it is written and a mismatch raises before the rename.
+        targetfile_name overrides the file name, skipping the URL parse when the caller already knows it.
     """
-    logger.debug('curl_retrieve_if_newer {} {} {}'.format(url, targetdir, check_newer))
-    iso_urlpath = urlparse(url)
+    logger.debug('curl_retrieve_if_newer %s %s %s', url, targetdir, check_newer)
+    if not targetfile_name:
+        targetfile_name = os.path.basename(urlparse(url).path)
     os.makedirs(targetdir, exist_ok=True)
-    # print("iso_urlpath={}".format(iso_urlpath))
-    targetfile = os.path.join(targetdir, os.path.basename(iso_urlpath.path))
+    targetfile = os.path.join(targetdir, targetfile_name)
+    headers = {}
 
     if os.path.exists(targetfile) and check_newer:
-        logger.info(" * Retrieving {} to {} if newer".format(url, targetfile))
-        subprocess.run(['curl', '-z', targetfile, '-o', targetfile, url], capture_output=True)
+        logger.info(" * Retrieving %s to %s if newer", url, targetfile)
+        headers['If-Modified-Since'] = email.utils.formatdate(os.path.getmtime(targetfile), usegmt=True)
     else:
-        logger.info(" * Retrieving {} to {}".format(url, targetfile))
-        subprocess.run(['curl', '-o', targetfile, url], capture_output=True)
+        logger.info(" * Retrieving %s to %s", url, targetfile)
+
+    with session.get(url, headers=headers, stream=True, timeout=download_timeout) as r:
+        if r.status_code == 304:
+            logger.debug(" * %s not modified, keeping %s", url, targetfile)
+            if expected_sha256 and not hmac.compare_digest(sha256_file(targetfile), expected_sha256):
+                logger.info(" * Cached %s does not match checksum, retrieving again", targetfile)
+                return curl_retrieve_if_newer(url, targetdir, check_newer=False, expected_sha256=expected_sha256,
+                                              targetfile_name=targetfile_name)
+            return os.path.abspath(targetfile)
+        r.raise_for_status()
+        partfile = targetfile + '.part'
+        h = hashlib.sha256() if expected_sha256 else None
+        with open(partfile, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=download_chunk_size):
+                if h:
+                    h.update(chunk)
+                f.write(chunk)
+        if h and not hmac.compare_digest(h.hexdigest(), expected_sha256):
+            os.unlink(partfile)
+            raise Exception("Checksum mismatch retrieving {}".format(url))
+        os.replace(partfile, targetfile)
 
     return os.path.abspath(targetfile)
 
 
 def check_checksums(directory: str, sha256file: str):
     """
-    Check the SHA256 sums using the specified sha256 hash file
-    :param directory:
+    Check the SHA256 sums using the specified sha256 hash file (sha256sum format), hashing in-process.
+    :param directory: directory the file names in sha256file are relative to
     :param sha256file:
-    :return:
+    :return: 0 if every listed file matches, 1 otherwise (same convention as sha256sum -c)
     """
-    logger.debug('check_checksums {} {}'.format(directory, sha256file))
-    os.chdir(directory)
-    cp = logged_subcommand_run(['sha256sum', '-c', sha256file], logger, logger.DEBUG)
-    return cp.returncode
-
-
-def check_update_cached_alpine_iso(cachedir: str, iso_url: str, sha256_url: str):
+    logger.debug('check_checksums %s %s', directory, sha256file)
+    entries = parse_sha256file(os.path.join(directory, sha256file))
+    if not entries:
+        return 1
+    paths = [os.path.join(directory, filename) for expected, filename in entries]
+    for path in paths:
+        if not os.path.exists(path):
+            logger.debug('check_checksums %s missing', path)
+            return 1
+    # hashlib releases the GIL on large updates, so several listed files hash in parallel
+    with ThreadPoolExecutor(max_workers=min(4, len(paths))) as pool:
+        digests = list(pool.map(sha256_file, paths))
+    for (expected, filename), path, digest in zip(entries, paths, digests):
+        if not hmac.compare_digest(digest, expected):
+            logger.debug('check_checksums %s FAILED', path)
+            return 1
+    return 0
+
+
+def verified_sidecar_matches(path: str, sha256: str):
+    """
+    True when path's '.verified' sidecar records this sha256 and the file's size and mtime are unchanged since
+    it was verified, so the hash pass can be skipped.
+    """
+    try:
+        st = os.stat(path)
+        with open(path + '.verified', 'r') as f:
+            verified = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (verified.get('size') == st.st_size and verified.get('mtime_ns') == st.st_mtime_ns
+            and hmac.compare_digest(str(verified.get('sha256', '')), sha256))
+
+
+def write_verified_sidecar(path: str, sha256: str):
+    """Record that path currently hashes to sha256, keyed on its size and mtime."""
+    st = os.stat(path)
+    with open(path + '.verified.tmp', 'w') as f:
+        json.dump({'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha256': sha256}, f)
+    os.replace(path + '.verified.tmp', path + '.verified')
+
+
+def check_update_cached_alpine_iso(cachedir: str, iso_url: str, sha256_url: str, iso_name: str = None,
+                                   sha256_name: str = None):
     """
     Retrieve and pass filehandle for ISO.
 
     :param cachedir: Cache directory to check/download file
     :param iso_url: ISO image to download
     :param sha256_url: SHA256 file to download matching ISO file
+    :param iso_name: cached file name for iso_url, if already known (parsed from the URL otherwise)
+    :param sha256_name: cached file name for sha256_url, if already known (parsed from the URL otherwise)
     :return: filehandle for downloaded file
     """
 
-    iso_urlpath = urlparse(iso_url)
-    sha256_urlpath = urlparse(sha256_url)
-    image_tarball_file = os.path.join(cachedir, os.path.basename(iso_urlpath.path))
-    sha256file = os.path.join(cachedir, os.path.basename(sha256_urlpath.path))
-
-    # print("Check: {} {} {}".format(os.path.exists(isofile),os.path.exists(sha256file),check_checksums(cachedir, sha256file)))
-    if os.path.exists(image_tarball_file) and os.path.exists(sha256file) and check_checksums(cachedir, sha256file) == 0:
-        print("Good integrity image file present: "+image_tarball_file)
-        return image_tarball_file
-
-    curl_retrieve_if_newer(iso_url, './cache')
-    sha256file = curl_retrieve_if_newer(sha256_url, cachedir, check_newer=False)
-    if check_checksums(cachedir, sha256file) != 0:
+    if not iso_name:
+        iso_name = os.path.basename(urlparse(iso_url).path)
+    if not sha256_name:
+        sha256_name = os.path.basename(urlparse(sha256_url).path)
+    image_tarball_file = os.path.join(cachedir, iso_name)
+    sha256file = os.path.join(cachedir, sha256_name)
+
+    cached_tarball_failed = False
+    if os.path.exists(image_tarball_file) and os.path.exists(sha256file):
+        expected_sha256 = dict((name, digest) for digest, name in parse_sha256file(sha256file)).get(iso_name)
+        if expected_sha256 and verified_sidecar_matches(image_tarball_file, expected_sha256):
+            print("Good integrity image file present (previously verified): "+image_tarball_file)
+            return image_tarball_file
+        if check_checksums(cachedir, sha256file) == 0:
+            if expected_sha256:
+                write_verified_sidecar(image_tarball_file, expected_sha256)
+            print("Good integrity image file present: "+image_tarball_file)
+            return image_tarball_file
+        cached_tarball_failed = True
+
+    # The sha256 file is tiny, so fetch it first and verify the tarball while it streams to disk,
+    # rather than re-reading the whole tarball afterward
+    sha256file = curl_retrieve_if_newer(sha256_url, cachedir, check_newer=False, targetfile_name=sha256_name)
+    digests = dict((name, digest) for digest, name in parse_sha256file(sha256file))
+    expected_sha256 = digests.get(iso_name)
+    if not expected_sha256:
         print("Checksum problem!")
-        raise Exception("Foo!")
-    # check hash?
+        raise Exception("No checksum for {} in {}".format(image_tarball_file, sha256file))
+    # A cached tarball that just failed verification is known bad: fetch unconditionally rather than send
+    # If-Modified-Since, whose usual 304 would only re-hash the bad file before fetching anyway
+    curl_retrieve_if_newer(iso_url, cachedir, check_newer=not cached_tarball_failed, expected_sha256=expected_sha256,
+                           targetfile_name=iso_name)
+    write_verified_sidecar(image_tarball_file, expected_sha256)
     print ("Returning {}".format(image_tarball_file))
     return image_tarball_file
 
 
+def stream_tarball_to_fat_image(tarball: str, fat_image: str):
+    """
+    Copy the contents of a gzipped tarball straight into a FAT image with mtools, without extracting to disk.
+    :param tarball: path to the .tar.gz to read (streamed, no seeks)
+    :param fat_image: path to a formatted FAT image file
+    :return:
+    """
+    logger.debug('stream_tarball_to_fat_image %s %s', tarball, fat_image)
+    created_dirs = set()
+
+    def ensure_dir(path: str):
+        if not path or path in created_dirs:
+            return
+        ensure_dir(os.path.dirname(path))
+        cp = logged_subcommand_run(['mmd', '-i', fat_image, '::' + path], logger, logging.DEBUG)
+        if cp.returncode != 0:
+            raise Exception("mmd failed creating {} in {}".format(path, fat_image))
+        created_dirs.add(path)
+
+    with open_tarball_stream(tarball) as tf:
+        for member in tf:
+            name = os.path.normpath(member.name).lstrip('/')
+            if name in ('', '.'):
+                continue
+            if member.isdir():
+                ensure_dir(name)
+            elif member.isfile():
+                ensure_dir(os.path.dirname(name))
+                logger.debug("mcopy %s -> ::%s", member.name, name)
+                cmd = ['mcopy', '-o', '-i', fat_image, '-', '::' + name]
+                proc = subprocess.Popen(cmd, executable=spawn_executable(cmd), stdin=subprocess.PIPE,
+                                        stdout=subprocess.DEVNULL, close_fds=False)
+                # If mcopy exits early (image full, bad name) the write hits a broken pipe; always close and reap
+                # the child, and report mcopy's failure rather than the BrokenPipeError
+                broken_pipe = False
+                try:
+                    shutil.copyfileobj(tf.extractfile(member), proc.stdin, length=1 << 20)
+                except BrokenPipeError:
+                    broken_pipe = True
+                finally:
+                    try:
+                        proc.stdin.close()
+                    except BrokenPipeError:
+                        broken_pipe = True
+                    returncode = proc.wait()
+                if returncode != 0 or broken_pipe:
+                    raise Exception("mcopy failed writing {} to {} (exit {})".format(name, fat_image, returncode))
+            else:
+                # FAT has no links or device nodes
+                logger.debug("Skipping non-regular tar member %s", member.name)
+
+
 def create_loopback_image(out_dir: str, target_size_bytes: int, tarfile=None, leave_tempfiles=False):
     target_img = os.path.join(out_dir, 'image.img')
-    sd_part0_image_size = 1024 * 1024 # 1MB, aligned for disk label
     sd_part1_image = os.path.join(out_dir, 'part_01.img')
-    sd_part1_image_size = 256 * 1024 * 1024 # 256MB for now -
     sd_part2_image = os.path.join(out_dir, 'part_02.img')
-    sd_part2_image_size = 1 * 1024 * 1024 * 1024 # 1GB for now
-    part1_contents_dir = os.path.join(out_dir, 'part1_contents')
     if not tarfile:
         raise Exception("No good tarfile")
 
-    print("Creating Partition 1, FAT32, file={}, size={}".format(sd_part1_image, humanbytes(sd_part1_size)))
-    if os.path.exists(sd_part1_image):
-        print("Clearing existing tempfile: {}".format(sd_part1_image))
-        os.remove(sd_part1_image)
+    for f in [sd_part1_image, sd_part2_image]:
+        if os.path.exists(f):
+            print("Clearing existing tempfile: {}".format(f))
+            os.remove(f)
 
-    # Filesystem size is given in kB by default
-    cmd = ['mkfs.fat', '-C', '-F32', '-n', '\"BOOT\"', sd_part1_image, str(int(sd_part1_image_size / 1024))]
-    cp = logged_subcommand_run(cmd, logger, logger.DEBUG)
+    # Neither file is zero-filled.  The FAT image receives thousands of small files, so reserve its extents
+    # up front for a contiguous layout; the much larger, mostly empty ext4 image stays sparse.
+    create_preallocated_file(sd_part1_image, image_layout.part1)
+    create_sparse_file(sd_part2_image, image_layout.part2)
 
-    print("Creating Partition 2, ext4, file={}, size={}".format(sd_part2_image, humanbytes(sd_part2_size)))
-    if os.path.exists(sd_part2_image):
-        print("Clearing existing tempfile: {}".format(sd_part2_image))
-        os.remove(sd_part2_image)
-    # Filesystem size is given in kB by default
-    cmd = ['mkfs.ext4', '-t', 'ext4', '-L', '\"root\"', sd_part2_image, str(int(sd_part2_image_size / 1024))]
-    cp = logged_subcommand_run(cmd, logger, logger.DEBUG)
+    # The two images are independent, so format ext4 (the slow one) in the background while partition 1 is
+    # formatted and populated
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        print("Creating Partition 2, ext4, file={}, size={}".format(sd_part2_image, humanbytes(image_layout.part2)))
+        cmd = [*mkfs_ext4_argv, sd_part2_image]
+        mkfs_ext4 = pool.submit(logged_subcommand_run, cmd, logger, logging.DEBUG)
 
-    print("Extracting Alpine image contents...")
-    os.makedirs(part1_contents_dir, exist_ok=True)
-    cmd = ['tar', '-xzf', tarfile, '-C', part1_contents_dir]
-    cp = logged_subcommand_run(cmd, logger, logger.DEBUG)
+        print("Creating Partition 1, FAT32, file={}, size={}".format(sd_part1_image, humanbytes(image_layout.part1)))
+        cmd = [*mkfs_fat_argv, sd_part1_image]
+        cp = logged_subcommand_run(cmd, logger, logging.DEBUG)
 
-    print("Populating Partition 1 with Alpine content")
-    cmd = ['mcopy', '-mvns', '-i', sd_part1_image, part1_contents_dir, '::']
-    cp = logged_subcommand_run(cmd, logger, logger.DEBUG)
+        print("Populating Partition 1 with Alpine content")
+        stream_tarball_to_fat_image(tarfile, sd_part1_image)
 
-    # https://unix.stackexchange.com/questions/281589/how-to-run-mkfs-on-file-image-partitions-without-mounting
+        cp = mkfs_ext4.result()
 
-    if not leave_tempfiles:
-        print(" ... removing {}".format(part1_contents_dir))
-        shutil.rmtree(part1_contents_dir)
+    # https://unix.stackexchange.com/questions/281589/how-to-run-mkfs-on-file-image-partitions-without-mounting
+    # The ext4 image is sparse; copy it with 'cp --sparse=always' / 'tar --sparse' to keep the holes
 
     for f in [sd_part1_image, sd_part2_image]:
         print(" ... tempfile {}".format(f))
@@ -160,123 +317,131 @@ def partition_device(blockdev: str):
     :param blockdev:
     :return:
     """
-    logger.info('partition_device({})'.format(blockdev))
+    logger.info('partition_device(%s)', blockdev)
 
     if not legal_block_dev_file(blockdev):
         raise Exception('Block device is not legal block dev: {} '.format(blockdev))
     blockdev_info = block_device_info(blockdev)
-    logger.debug("Block Device Info: {}".format(blockdev_info))
+    logger.debug("Block Device Info: %s", blockdev_info)
 
     # constraints to calc partition sizes
     # get size of device
-    total_size_sectors = block_device_size_sectors(blockdev)
+    total_size_sectors = blockdev_info['size']
+    block_shift = blockdev_info['physical_block_size_log2']
 
     # need x sectors for MBR
-    sd_part0_size: int = 1024 # 1 MiB label
-    sd_part0_size_sectors = int(sd_part0_size / blockdev_info['physical_block_size'])
+    sd_part0_size_sectors = image_layout.part0 >> block_shift
 
     # need y megabytes for Alpine image (start w/ 64)
     sd_part1_offset_sectors = blockdev_info['first_partition_offset_sectors']
-    sd_part1_size_bytes: int = 256 * 1024 * 1024
-    sd_part1_size_sectors = int(sd_part1_size_bytes / blockdev_info['physical_block_size'])
+    sd_part1_size_sectors = image_layout.part1 >> block_shift
 
     # use remainder for
     sd_part2_alignment_remainder = (sd_part0_size_sectors + sd_part1_size_sectors) % blockdev_info['alignment_boundary_sectors']
     sd_part2_alignment_fix = blockdev_info['alignment_boundary_sectors'] - sd_part2_alignment_remainder
     sd_part2_offset_sectors = sd_part0_size_sectors + sd_part1_size_sectors + sd_part2_alignment_fix
     sd_part2_size_sectors = total_size_sectors - sd_part0_size_sectors - sd_part1_size_sectors
-    sd_part2_size_bytes = int(sd_part2_size_sectors * blockdev_info['physical_block_size'])
-    logger.debug('sd_part2_alignment_offset={}, sd_part2_alignment_fix={}'.format(sd_part2_alignment_remainder, sd_part2_alignment_fix))
+    sd_part2_size_bytes = sd_part2_size_sectors << block_shift
+    logger.debug('sd_part2_alignment_offset=%s, sd_part2_alignment_fix=%s', sd_part2_alignment_remainder, sd_part2_alignment_fix)
 
 # parted commands
-    # call parted: 'sudo parted --script <devname> --script <script>'
+    # call parted: 'parted --script <devname> --script <script>'
     parted_script = 'mklabel msdos '
     parted_script = parted_script + "mkpart primary fat32 {}s {}s ".format(sd_part1_offset_sectors, sd_part1_size_sectors)
     parted_script = parted_script + "mkpart primary ext4 {}s {}s ".format(sd_part2_offset_sectors, sd_part2_size_sectors)
     parted_script = parted_script + "set 1 boot on "
     parted_script = parted_script + "set 1 lba on "
-    logger.debug('partition_device parted command: {}'.format(parted_script))
+    logger.debug('partition_device parted command: %s', parted_script)
 
-    # elevate()
-    # if not elevate.is_root():
-    #     logger.error("Unable to elevate privileges to root")
-    #     raise Exception("Unable to elevate privileges to root")
-    # else:
-    #     logger.debug("Privs elevated.")
-    parted_cmdline = ['sudo', 'parted', '--script', blockdev, "{}".format(parted_script)]
-    logger.debug('partition_device parted command: {}'.format(parted_cmdline))
-    cp = subprocess.run(parted_cmdline, capture_output=True)
-    cp = logged_subcommand_run(parted_cmdline, logger, logger.DEBUG)
-    logger.info('partition_device({}) COMPLETE'.format(blockdev))
+    parted_cmdline = ['parted', '--script', blockdev, "{}".format(parted_script)]
+    logger.debug('partition_device parted command: %s', parted_cmdline)
+    # One parted invocation with the whole script, so the device is opened and re-read once
+    cp = logged_subcommand_run(parted_cmdline, logger, logging.DEBUG)
+    cmd = ['partprobe', blockdev]
+    cp = logged_subcommand_run(cmd, logger, logging.DEBUG)
+    logger.info('partition_device(%s) COMPLETE', blockdev)
+
+
+def fat_extract_members(tf: tarfile.TarFile):
+    """
+    Yield the members of a streaming tarball that are safe to extract onto a FAT mount as root: dirs and regular
+    files whose normalized name stays inside the destination (not absolute, no leading '..').
+    :param tf: open tarfile
+    :return: generator of TarInfo
+    """
+    for member in tf:
+        if not (member.isdir() or member.isfile()):
+            continue
+        name = os.path.normpath(member.name)
+        if os.path.isabs(name) or name == os.pardir or name.startswith(os.pardir + os.sep):
+            logger.warning("Skipping tar member outside the destination: %s", member.name)
+            continue
+        yield member
 
 
 def provision_installer_partition(outdir: str, part_blockdev, alpine_tarfile: str, leave_tempfiles=False):
 
     # Filesystem size is given in kB by default
-    cmd = ['sudo', 'mkfs.fat', '-F32', '-n', '\"BOOT\"', part_blockdev]
-    logger.debug("Using: "+' '.join(cmd))
-    cp = subprocess.run(cmd)
+    cmd = [*mkfs_fat_argv, part_blockdev]
+    logger.debug("Using: %s", ' '.join(cmd))
+    cp = subprocess.run(cmd, executable=spawn_executable(cmd), close_fds=False)
 
     installer_fs_path = os.path.join(outdir, 'installer.fs')
     os.makedirs(installer_fs_path, exist_ok=True)
 
-    cmd = ['sudo', 'mount', '-t', 'vfat', part_blockdev, installer_fs_path]
-    logger.debug("Using: "+' '.join(cmd))
-    cp = subprocess.run(cmd)
-
-    logger.info("Extracting Alpine image contents...")
-    installer_tarcontents_path = os.path.join(outdir, 'alpine.tar')
-    os.makedirs(installer_tarcontents_path, exist_ok=True)
-    cmd = ['sudo', 'tar', '-xz', '-f', alpine_tarfile, '-C', installer_tarcontents_path]
-    logger.debug("Using: "+' '.join(cmd))
-    cp = subprocess.run(cmd)
-
-    cmd = ['sudo', 'cp', '-r', os.path.join(installer_tarcontents_path, '.'), installer_fs_path]
-    logger.debug("Copying installer contents from {} to {}, \n  {}".format(installer_tarcontents_path, installer_fs_path, cmd))
-    cp = subprocess.run(cmd)
-
-    # copy answerfile
-    # cmd = ['sudo', 'cp', '-r', os.path.join(installer_tarcontents_path, '.'), installer_fs_path]
-    # logger.debug("Copying installer contents from {} to {}, \n  {}".format(installer_tarcontents_path, installer_fs_path, cmd))
-    #cp = subprocess.run(cmd)
+    # 'quiet' so extraction's chown/chmod don't fail on modes FAT can't represent; async/noatime so the page cache
+    # coalesces the many small writes (vfat has no commit= option, and 'flush' is left off)
+    cmd = ['mount', '-t', 'vfat', '-o', 'async,noatime,quiet', part_blockdev, installer_fs_path]
+    logger.debug("Using: %s", ' '.join(cmd))
+    cp = subprocess.run(cmd, executable=spawn_executable(cmd), close_fds=False)
+
+    # Extract straight onto the mounted FAT in one streaming pass: no temp tree to write, copy back and delete.
+    # Needs root for the mount; main() elevates the whole process for liveimage.  FAT holds only dirs and files.
+    logger.info("Extracting Alpine image contents to %s", installer_fs_path)
+    # We run as root here: members with '..' or absolute paths are dropped by fat_extract_members on every Python,
+    # and the 'data' filter adds its checks (links, special modes) where available
+    extract_kwargs = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+    with open_tarball_stream(alpine_tarfile) as tf:
+        tf.extractall(installer_fs_path, members=fat_extract_members(tf), **extract_kwargs)
+
+    # Pay the writeback cost once, here, rather than per file
+    cmd = ['sync', '-f', installer_fs_path]
+    logger.debug("Using: %s", ' '.join(cmd))
+    cp = subprocess.run(cmd, executable=spawn_executable(cmd), close_fds=False)
 
     if not leave_tempfiles:
-        logger.debug("Cleaning up tarball contents in {}".format(installer_tarcontents_path))
-        shutil.rmtree(installer_tarcontents_path)
-
-        cmd = ['sudo', 'umount', installer_fs_path]
-        logger.debug("Unwinding mount: "+' '.join(cmd))
-        cp = subprocess.run(cmd)
+        cmd = ['umount', installer_fs_path]
+        logger.debug("Unwinding mount: %s", ' '.join(cmd))
+        cp = subprocess.run(cmd, executable=spawn_executable(cmd), close_fds=False)
         os.rmdir(installer_fs_path)
 
 
 def provision_root_partition(outdir: str, part_blockdev, leave_tempfiles=False):
 
     # Filesystem size is given in kB by default
-    cmd = ['sudo', 'mkfs.ext4', '-t', 'ext4', '-L', '\"root\"',  part_blockdev]
-    logger.debug("Using: "+' '.join(cmd))
-    cp = subprocess.run(cmd)
+    cmd = [*mkfs_ext4_argv, part_blockdev]
+    logger.debug("Using: %s", ' '.join(cmd))
+    cp = subprocess.run(cmd, executable=spawn_executable(cmd), close_fds=False)
 
     root_fs_path = os.path.join(outdir, 'root.fs')
     os.makedirs(root_fs_path, exist_ok=True)
 
-    cmd = ['sudo', 'mount', '-t', 'ext4', part_blockdev, root_fs_path]
-    logger.debug("Using: "+' '.join(cmd))
-    cp = subprocess.run(cmd)
+    cmd = ['mount', '-t', 'ext4', '-o', 'data=writeback,commit=60,noatime', part_blockdev, root_fs_path]
+    logger.debug("Using: %s", ' '.join(cmd))
+    cp = subprocess.run(cmd, executable=spawn_executable(cmd), close_fds=False)
 
     if not leave_tempfiles:
-        cmd = ['sudo', 'umount', root_fs_path]
-        logger.debug("Unwinding mount: "+' '.join(cmd))
-        cp = subprocess.run(cmd)
+        cmd = ['umount', root_fs_path]
+        logger.debug("Unwinding mount: %s", ' '.join(cmd))
+        cp = subprocess.run(cmd, executable=spawn_executable(cmd), close_fds=False)
         os.rmdir(root_fs_path)
 
 
 def makedirs():
-    cwd = os.path.abspath(os.path.curdir)
-    out = os.path.join(cwd, 'out')
-    os.makedirs(out, exist_ok=True)
-    cache = os.path.join(cwd, 'cache')
-    os.makedirs(out, exist_ok=True)
+    cwd = os.getcwd()
+    out, cache = os.path.join(cwd, 'out'), os.path.join(cwd, 'cache')
+    for d in (out, cache):
+        os.makedirs(d, exist_ok=True)
     return cwd, out, cache
 
 
@@ -288,8 +453,11 @@ def main():
     parser.add_argument("--imagesize", help="Target image size in bytes", type=str)
     parser.add_argument("--device", help="Target device handle", type=str)
     parser.add_argument("--messy", help="Don't clean up temp files and mounts", action='count')
+    parser.add_argument("--verbose", help="Log debug output", action='store_true')
     args = parser.parse_args()
-    target_image_size = sd_target_image_size
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    target_image_size = image_layout.target
     cwd, out, cache = makedirs()
     blockdev = None
     messy = True if args.messy else False
@@ -307,21 +475,35 @@ def main():
         parser.print_usage()
         sys.exit(0)
 
+    if args.command == 'liveimage':
+        if not blockdev:
+            print("ERROR: Please specify valid target block device, (set to {})".format(blockdev))
+            sys.exit(-1)
+
+        # Writing to the mounted partitions needs root; re-exec this process elevated.  Done before the tool
+        # check, since parted/mkfs.* live in sbin directories that are only on root's (sudo's secure_path) PATH.
+        if os.geteuid() != 0:
+            elevate(graphical=False)
+
+    missing = missing_tools(required_tools.get(args.command, ()))
+    if missing:
+        print("ERROR: Required tools not found on PATH: {}".format(', '.join(missing)))
+        sys.exit(-1)
+
     if args.command == 'init':
-        alpinefile = check_update_cached_alpine_iso(cache, alpine_url, alpine_sha256_url)
+        alpinefile = check_update_cached_alpine_iso(cache, alpine_url, alpine_sha256_url,
+                                                    alpine_basename, alpine_sha256_basename)
         sys.exit(0)
 
     if args.command == 'file':
-        alpinefile = check_update_cached_alpine_iso(cache, alpine_url, alpine_sha256_url)
+        alpinefile = check_update_cached_alpine_iso(cache, alpine_url, alpine_sha256_url,
+                                                    alpine_basename, alpine_sha256_basename)
         create_loopback_image(out, target_image_size, leave_tempfiles=messy, tarfile=alpinefile)
         sys.exit(0)
 
     if args.command == 'liveimage':
-        if not blockdev:
-            print("ERROR: Please specify valid target block device, (set to {})".format(blockdev))
-            sys.exit(-1)
-
-        alpinefile = check_update_cached_alpine_iso(cache, alpine_url, alpine_sha256_url)
+        alpinefile = check_update_cached_alpine_iso(cache, alpine_url, alpine_sha256_url,
+                                                    alpine_basename, alpine_sha256_basename)
         partition_device(blockdev)
         provision_installer_partition(out, blockdev+'1', alpinefile, leave_tempfiles=messy)
         provision_root_partition(out, blockdev+'2', leave_tempfiles=messy)
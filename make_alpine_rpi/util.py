@@ -1,44 +1,156 @@
+import collections
+import contextlib
+import errno
+import functools
+import hashlib
 import os
 import re
+import shutil
 import stat
 import subprocess
 import logging
+import tarfile
+import threading
+
+try:
+    # Optional: ISA-L accelerated inflate, drop-in for the gzip module
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+tarball_read_bufsize = 2 << 20 # 2 MiB
+hash_read_bufsize = 1 << 20 # 1 MiB
+
+
+# (divisor, suffix) indexed by floor(log2(bytes) / 10)
+humanbytes_units = [(1, 'Bytes'), (1 << 10, 'KB'), (1 << 20, 'MB'), (1 << 30, 'GB'), (1 << 40, 'TB')]
 
 
 def humanbytes(B: int):
     """Return the given bytes as a human friendly KB, MB, GB, or TB string"""
-    # from https://stackoverflow.com/questions/12523586/python-format-size-application-converting-b-to-kb-mb-gb-tb
-    B = float(B)
-    KB = float(1024)
-    MB = float(KB ** 2) # 1,048,576
-    GB = float(KB ** 3) # 1,073,741,824
-    TB = float(KB ** 4) # 1,099,511,627,776
-
-    if B < KB:
-        return '{0} {1}'.format(B,'Bytes' if 0 == B > 1 else 'Byte')
-    elif KB <= B < MB:
-        return '{0:.2f} KB'.format(B/KB)
-    elif MB <= B < GB:
-        return '{0:.2f} MB'.format(B/MB)
-    elif GB <= B < TB:
-        return '{0:.2f} GB'.format(B/GB)
-    elif TB <= B:
-        return '{0:.2f} TB'.format(B/TB)
+    # originally from https://stackoverflow.com/questions/12523586/python-format-size-application-converting-b-to-kb-mb-gb-tb
+    i = min(len(humanbytes_units) - 1, max(0, (int(B).bit_length() - 1) // 10))
+    if i == 0:
+        return '{0} {1}'.format(float(B), 'Byte' if B == 1 else 'Bytes')
+    div, suffix = humanbytes_units[i]
+    return '{0:.2f} {1}'.format(B / div, suffix)
 
 
 # based on https://stackoverflow.com/a/42865957/2002471
 units = {"B": 1, "KB": 2**10, "MB": 2**20, "GB": 2**30, "TB": 2**40, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
 
 
+# trailing unit suffix, e.g. the 'GB' in '4GB' or '4 GB'; matches empty for a bare number
+size_unit_re = re.compile(r'[KMGT]?B?$')
+
+
 def parse_size(size):
-    size = size.upper()
-    #print("parsing size ", size)
-    if not re.match(r' ', size):
-        size = re.sub(r'([KMGT]?B?)', r' \1', size)
-    number, unit = [string.strip() for string in size.split()]
+    size = size.strip().upper()
+    if size.isdigit():
+        return int(size)
+    m = size_unit_re.search(size)
+    number, unit = size[:m.start()].strip(), m.group(0) or 'B'
     return int(float(number)*units[unit])
 
 
+@contextlib.contextmanager
+def open_tarball_stream(tarball: str):
+    """
+    Open a gzipped tarball as a streaming (no seek) tarfile.TarFile.  Decompresses through pigz when it is on the
+    PATH so gunzip runs on all cores, else through isal's igzip if installed, else the stdlib gzip module.
+    :param tarball: path to the .tar.gz
+    :return: context manager yielding the open TarFile
+    """
+    pigz = which('pigz')
+    if pigz:
+        proc = subprocess.Popen([pigz, '-dc', tarball], stdout=subprocess.PIPE, bufsize=tarball_read_bufsize,
+                                close_fds=False)
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode='r|', bufsize=tarball_read_bufsize) as tf:
+                yield tf
+        finally:
+            proc.stdout.close()
+            if proc.wait() not in (0, -13): # -13: SIGPIPE when the reader stops early
+                raise Exception("pigz failed decompressing {}".format(tarball))
+    elif igzip:
+        with igzip.open(tarball, 'rb') as gz:
+            with tarfile.open(fileobj=gz, mode='r|', bufsize=tarball_read_bufsize) as tf:
+                yield tf
+    else:
+        with tarfile.open(tarball, mode='r|gz', bufsize=tarball_read_bufsize) as tf:
+            yield tf
+
+
+# '<64 hex digest> <name>' line of a sha256sum-format file
+sha256_line_re = re.compile(r'([0-9a-fA-F]{64})\s+(\S.*)')
+
+
+def parse_sha256file(path: str):
+    """
+    Parse a sha256sum-format file into a list of (lowercase hex digest, file name) tuples.  Malformed lines
+    (e.g. an HTML error page saved in place of the file) are skipped, so a file with no usable entry yields an
+    empty list, which callers treat as failed verification.
+    """
+    entries = []
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                m = sha256_line_re.fullmatch(line.strip())
+                if not m:
+                    continue
+                # sha256sum marks binary-mode entries with a leading '*'
+                entries.append((m.group(1).lower(), m.group(2).strip().lstrip('*')))
+    except UnicodeDecodeError:
+        return []
+    return entries
+
+
+def sha256_file(path: str):
+    """Return the hex SHA256 digest of the given file, hashed in-process (OpenSSL, SHA-NI where available)."""
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        # Same loop hashlib.file_digest uses, but with a 1 MiB buffer rather than its fixed 256 KiB:
+        # readinto one preallocated buffer, no per-chunk bytes objects
+        h = hashlib.sha256()
+        buf = bytearray(hash_read_bufsize)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+        return h.hexdigest()
+
+
+def create_sparse_file(path: str, size_bytes: int):
+    """Create (or truncate) the given file as a sparse file of the given size, without writing any zeros."""
+    fd = os.open(path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size_bytes)
+    finally:
+        os.close(fd)
+
+
+def create_preallocated_file(path: str, size_bytes: int):
+    """
+    Create (or truncate) the given file with size_bytes of extents reserved up front via posix_fallocate.  On
+    filesystems with native fallocate this is a metadata operation; elsewhere glibc emulates it by writing every
+    block.  Falls back to a sparse file only where preallocation is unsupported; real errors (ENOSPC, EFBIG)
+    are raised.
+    """
+    fd = os.open(path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC, 0o644)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, size_bytes)
+        except AttributeError:
+            os.ftruncate(fd, size_bytes)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+            os.ftruncate(fd, size_bytes)
+    finally:
+        os.close(fd)
 
 
 def legal_block_dev_file(dev: str):
@@ -46,8 +158,15 @@ def legal_block_dev_file(dev: str):
     return os.path.exists(dev) and stat.S_ISBLK(os.stat(dev).st_mode)
 
 
+# fallback for device paths the plain '/dev/<name>' check below doesn't accept
+devicename_re = re.compile(r'/dev/(\w+)')
+
+
 def devicename_from_dev_file(dev: str):
-    m = re.match("\/dev\/(\w+)", dev)
+    name = dev[5:]
+    if dev.startswith('/dev/') and name.isalnum():
+        return name
+    m = devicename_re.match(dev)
     if m:
         return m.group(1)
     raise Exception("Unparseable device name {}".format(dev))
@@ -55,38 +174,33 @@ def devicename_from_dev_file(dev: str):
 
 def block_device_size_sectors(dev: str):
     """ Retrieves the device size from linux block device, in 512 byte sectors. """
-    devname = devicename_from_dev_file(dev)
-    with open('/sys/class/block/'+devname+'/size', 'r') as p:
-        return int(p.readline().rstrip('\n'))
+    return block_device_info(dev)['size']
 
 
+@functools.lru_cache(maxsize=8)
 def block_device_info(dev: str):
+    """ Reads the size/alignment attributes for a block device from sysfs.  Memoized per device for the run;
+        callers must not mutate the returned dict. """
 
     # thanks to https://rainbow.chard.org/2013/01/30/how-to-align-partitions-for-best-performance-using-parted/
     devname = devicename_from_dev_file(dev)
     blockvals = {}
-    with open('/sys/class/block/'+devname+'/size', 'r') as p:
-        size_sectors = int(p.readline().rstrip('\n'))
-        blockvals['size'] = size_sectors
-
-    with open('/sys/block/'+devname+'/queue/optimal_io_size', 'r') as p:
-        optimal_io_size = int(p.readline().rstrip('\n'))
-        blockvals['optimal_io_size'] = optimal_io_size
+    with open('/sys/class/block/'+devname+'/size', 'rb') as p:
+        blockvals['size'] = int(p.read())
 
-    with open('/sys/block/'+devname+'/queue/minimum_io_size', 'r') as p:
-        minimum_io_size = int(p.readline().rstrip('\n'))
-        blockvals['minimum_io_size'] = minimum_io_size
-
-    if not os.path.exists('/sys/block/'+devname+'/queue/alignment_offset'):
-        blockvals['alignment_offset'] = 0
-    else:
-        with open('/sys/block/'+devname+'/queue/alignment_offset', 'r') as p:
-            alignment_offset = int(p.readline().rstrip('\n'))
-            blockvals['alignment_offset'] = alignment_offset
-
-    with open('/sys/block/'+devname+'/queue/physical_block_size', 'r') as p:
-        physical_block_size = int(p.readline().rstrip('\n'))
-        blockvals['physical_block_size'] = physical_block_size
+    # One directory listing answers whether the optional attributes exist, instead of a stat each
+    queue_dir = '/sys/block/'+devname+'/queue/'
+    with os.scandir(queue_dir) as it:
+        queue_attrs = {entry.name for entry in it}
+    for attr in ('optimal_io_size', 'minimum_io_size', 'alignment_offset', 'physical_block_size'):
+        if attr == 'alignment_offset' and attr not in queue_attrs:
+            # older kernels don't expose it
+            blockvals[attr] = 0
+            continue
+        with open(queue_dir + attr, 'rb') as p:
+            blockvals[attr] = int(p.read())
+    # Always a power of two (512, 4096, ...), so sector conversions can shift
+    blockvals['physical_block_size_log2'] = blockvals['physical_block_size'].bit_length() - 1
 
     # hopefully this is right:
     # https://access.redhat.com/documentation/en-us/red_hat_enterprise_linux/7/html/storage_administration_guide/iolimpartitionfstools
@@ -95,24 +209,72 @@ def block_device_info(dev: str):
     else:
         blockvals['alignment_boundary'] = blockvals['optimal_io_size'] + blockvals['alignment_offset']
 
-    blockvals['alignment_boundary_sectors'] = int( blockvals['alignment_boundary'] /
-                                                   blockvals['physical_block_size'] )
-    blockvals['first_partition_offset_sectors'] = int(blockvals['alignment_boundary'] /
-                                                      blockvals['physical_block_size'])
+    blockvals['alignment_boundary_sectors'] = blockvals['alignment_boundary'] >> blockvals['physical_block_size_log2']
+    blockvals['first_partition_offset_sectors'] = blockvals['alignment_boundary_sectors']
 
     return blockvals
 
 
+# Subprocess launch invariant: CPython only takes its posix_spawn (vfork, no page-table copy) path when
+# close_fds=False, no cwd=/preexec_fn=/start_new_session=/shell=True, and the executable has a directory
+# component.  Every launch here passes close_fds=False and executable=spawn_executable(cmd); keep it that way.
+@functools.lru_cache(maxsize=None)
+def which(name: str):
+    """shutil.which, memoized: each tool's PATH walk happens once per run."""
+    return shutil.which(name)
+
+
+def missing_tools(names):
+    """Return the names from the given iterable that are not found on PATH."""
+    return [name for name in names if not which(name)]
+
+
+def spawn_executable(cmdline: list):
+    """Return the absolute path for cmdline[0] from PATH (None if not found, leaving lookup to subprocess)."""
+    return which(cmdline[0])
+
+
+def _log_stream_lines(stream, prefix: str, logger: logging.Logger, log_level: int, tail: collections.deque = None):
+    """Log each line from the given binary pipe as it arrives, until EOF.  The pipe is always drained, but lines
+    are only decoded when the level is enabled.  If tail is given, the last raw lines are kept in it."""
+    enabled = logger.isEnabledFor(log_level)
+    for line in iter(stream.readline, b''):
+        if enabled:
+            logger.log(log_level, "%s %s", prefix, line.decode('utf-8', errors='replace').rstrip())
+        if tail is not None:
+            tail.append(line)
+    stream.close()
+
+
 def logged_subcommand_run(cmdline: list, logger: logging.Logger, log_level: int):
     """
-    Run the specified command using subcommand.run(), and push any Standard Out/Error to the specified logger and level.
+    Run the specified command, streaming any Standard Out/Error to the specified logger and level line by line
+    as it is produced (so the child never stalls on a full pipe, and output is never held in memory).
+    When log_level is filtered out, stdout goes straight to /dev/null; only the tail of stderr is kept, and it
+    is logged as a warning if the command fails.
     :param cmdline: The command line to execute, in the form expected by subcommand.run()
     :param logger: a logging.Logger instance
     :param log_level: the (integer) logging level, as defined in Logger
-    :return: the command result returned from run()
+    :return: a CompletedProcess carrying the return code (stdout/stderr are not captured)
     """
-    logger.log("Running subcommand: {}").format(cmdline)
-    cp = subprocess.run(cmdline, capture_output=True)
-    logger.log(log_level, "{} STDOUT {}".format(cmdline[0], str(cp.stdout.decode('utf-8'))))
-    logger.log(log_level, "{} STDERR {}".format(cmdline[0], str(cp.stderr.decode('utf-8'))))
-    return cp
\ No newline at end of file
+    logger.log(log_level, "Running subcommand: %s", cmdline)
+    enabled = logger.isEnabledFor(log_level)
+    stderr_tail = collections.deque(maxlen=20)
+    # close_fds=False is safe: the pipes subprocess creates are already close-on-exec
+    proc = subprocess.Popen(cmdline, executable=spawn_executable(cmdline),
+                            stdout=subprocess.PIPE if enabled else subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, bufsize=1 << 20, close_fds=False)
+    readers = [threading.Thread(target=_log_stream_lines,
+                                args=(proc.stderr, cmdline[0] + ' STDERR', logger, log_level, stderr_tail))]
+    if enabled:
+        readers.append(threading.Thread(target=_log_stream_lines,
+                                        args=(proc.stdout, cmdline[0] + ' STDOUT', logger, log_level)))
+    for t in readers:
+        t.start()
+    returncode = proc.wait()
+    for t in readers:
+        t.join()
+    if returncode != 0 and not enabled:
+        logger.warning("%s exited %s: %s", cmdline[0], returncode,
+                       b''.join(stderr_tail).decode('utf-8', errors='replace').rstrip())
+    return subprocess.CompletedProcess(cmdline, returncode)